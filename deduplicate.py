@@ -10,52 +10,73 @@ from dupe_utils import FileUtil, ProcessTimer
 from dupe_analysis import DupeAnalysis
 
 class DupeFile:
+    # there can be millions of these, so no per-instance __dict__
+    __slots__ = ('path', 'parent', 'depth', 'hash', 'size',
+                 'is_deleted', 'is_kept', 'duplicates', 'dupe_dirs',
+                 'deleted_by', 'owners')
+    parent_of = staticmethod(FileUtil.parent)
+
     def __init__(self, file, hash='', size=0):
         # self.parent_dd = None
         self.path = file
-        self.parent = FileUtil.parent(file)
-        path_parts = FileUtil.splitpath(file)
-        self.depth = len(path_parts)
+        self.parent = self.parent_of(file)
+        self.depth = FileUtil.depth(file)
         self.hash = hash
         self.size = size
         self.is_deleted = False
         self.is_kept = False
-        self.duplicates = set()
-        self.dupe_dirs = set()
+        self.duplicates = ()
+        self.dupe_dirs = frozenset()
         self.deleted_by = None
+        # DupeDirs that hold this in file_dupes/subdir_dupes
+        self.owners = ()
 
-    def set_dupes(self, df_list):
-        for df in df_list:
-            if df != self:
-                self.duplicates.add(df)
-                self.dupe_dirs.add(df.parent)
+    def set_dupes(self, group, dupe_dirs):
+        # group holds every file with this hash (self included) and
+        #  dupe_dirs all of their parents; both are shared by the whole
+        #  group rather than built per file
+        self.duplicates = group
+        self.dupe_dirs = dupe_dirs
 
     def delete(self, keep):
-        deletes = set()
-        if not self.is_deleted and not self.is_kept:
-            deletes.add(self)
-            # print('delete():', self.path)
-            self.is_deleted = True
-            self.deleted_by = keep
-        return deletes
+        """Returns self if this call deleted the file, else None"""
+        if self.is_deleted or self.is_kept:
+            return None
+        # print('delete():', self.path)
+        self.is_deleted = True
+        self.deleted_by = keep
+        for owner in self.owners:
+            owner.live_files -= 1
+        return self
 
     def keep(self, dwd):
-        deletes = set()
-        keeps = set()
-        if not self.is_deleted:
-            self.is_kept = True
-            # print('keep', self.path)
-            # delete the duplicates
-            for dupe in self.duplicates:
-                deletes.update(dupe.delete(self))
-            keeps.add(self)
-        return keeps, deletes
+        """Returns lists of the kept file and the duplicates it deleted"""
+        if self.is_deleted:
+            return [], []
+        self.is_kept = True
+        # print('keep', self.path)
+        # delete the duplicates
+        deletes = []
+        for dupe in self.duplicates:
+            if dupe is not self and dupe.delete(self) is not None:
+                deletes.append(dupe)
+        return [self], deletes
 
     def __repr__(self):
         # return f"\n DupeFile({pformat(vars(self), indent=2, width=1)})"
         return f"DupeFile({self.path})"
 
 class DupeDir(DupeFile):
+    __slots__ = ('subdir_dupes', 'subdir_uniqs', 'file_dupes', 'file_uniqs',
+                 'count', 'count_total', 'extra', 'extra_total',
+                 'kept', 'kept_total', 'is_full_dupe', 'is_superset',
+                 'dupe_children', 'dd_dupes', 'live_files', 'live_subdirs',
+                 'manual')
+
+    # where the parent walks stop
+    root_path = 'C:\\' if platform.system() == "Windows" else '/'
+    parent_of = staticmethod(FileUtil.dir_parent)
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         # self.parent_dd = None
@@ -73,7 +94,10 @@ class DupeDir(DupeFile):
         self.is_full_dupe = False
         self.dupe_children = set()
         self.dd_dupes = set()
-        self.fs_root = DupeDir.fs_root()
+        # file_dupes and subdir_dupes that are not deleted yet, kept
+        #  up to date by the children so is_empty() needn't scan
+        self.live_files = 0
+        self.live_subdirs = 0
         # self.is_superset = False
         self.manual = True
         # self.is_root = False
@@ -96,26 +120,29 @@ class DupeDir(DupeFile):
                 self.has_no_dupedirs() and
                 self.has_no_dupefiles())
 
-    def is_kept(self):
-        return self.is_kept
-
     def has_no_extras(self):
         return (not(self.has_nondupe_files()) and
                 not(self.has_nondupe_subdirs()))
 
     def has_no_dupedirs(self):
-        if len(self.subdir_dupes) > 0:
-            for sd in self.subdir_dupes:
-                if not sd.is_deleted:
-                    return False
-        return True
+        return self.live_subdirs == 0
 
     def has_no_dupefiles(self):
-        if len(self.file_dupes) > 0:
-            for fd in self.file_dupes:
-                if not fd.is_deleted:
-                    return False
-        return True
+        return self.live_files == 0
+
+    def add_file_dupe(self, df):
+        if df not in self.file_dupes:
+            self.file_dupes.add(df)
+            df.owners += (self,)
+            if not df.is_deleted:
+                self.live_files += 1
+
+    def add_subdir_dupe(self, dd):
+        if dd not in self.subdir_dupes:
+            self.subdir_dupes.add(dd)
+            dd.owners += (self,)
+            if not dd.is_deleted:
+                self.live_subdirs += 1
 
     def has_nondupe_files(self):
         return len(self.file_uniqs) > 0
@@ -137,9 +164,9 @@ class DupeDir(DupeFile):
         dirs = ret['subdirs']
         for filename in filenames:
             full_path = filename
-            if full_path in dupe_files:
-                df = dupe_files[full_path]
-                self.file_dupes.add(df)
+            df = dupe_files.get(full_path)
+            if df is not None:
+                self.add_file_dupe(df)
                 self.dd_dupes.update(df.dupe_dirs)
                 self.size += df.size
                 self.count += 1
@@ -150,10 +177,10 @@ class DupeDir(DupeFile):
         self.extra_total += self.extra
         for dir in dirs:
             full_path = dir
-            if full_path in dupe_dirs:
+            dd = dupe_dirs.get(full_path)
+            if dd is not None:
                 # print('fp', full_path)
-                dd = dupe_dirs[full_path]
-                self.subdir_dupes.add(dd)
+                self.add_subdir_dupe(dd)
                 # dd.parent_dd = self
                 all_dupedirs_are_full = all_dupedirs_are_full and dd.is_full_dupe
                 self.count_total += dd.count_total
@@ -181,16 +208,14 @@ class DupeDir(DupeFile):
         parent = self.parent
         prev_dd = self
         while parent not in stop_dirs:
-            if parent not in dupe_dirs:
+            dd = dupe_dirs.get(parent)
+            if dd is None:
                 # print('fillp', parent)
                 dd = DupeDir(parent)
                 dupe_dirs[parent] = dd
                 dwd_depth[dd.depth].append(dd)
-            else:
-                dd = dupe_dirs[parent]
 
-            if prev_dd not in dd.dupe_children:
-                dd.dupe_children.add(prev_dd)
+            dd.dupe_children.add(prev_dd)
 
             if dd.manual:
                 dd.count_total += self.count_total
@@ -261,10 +286,7 @@ class DupeDir(DupeFile):
 
     @staticmethod
     def fs_root():
-        if platform.system() == "Windows":
-            return 'C:\\'
-        else:
-            return '/'
+        return DupeDir.root_path
 
     @staticmethod
     def calc_max(dupedir_list, dwd, past_kept=None):
@@ -273,51 +295,32 @@ class DupeDir(DupeFile):
         # once that's selected, figure out which dirs are actually
         #   keepable and plough through.
 
-        # filter out deletes.
+        # filter out deletes and keep the best directory as we go,
+        #  computing its key once and without a candidates list.
+        # the counts are ints so negating them gives the descending
+        # order without a wrapper object per comparison.
         # print('calc_max(): dupedir_list\n', pformat(dupedir_list))
-        filtered_list = set()
+        best = best_key = None
         for d in dupedir_list:
-            if not d.is_deleted and d.get_first_keepable() > 0:
-                filtered_list.add(d)
-
-        if len(filtered_list) == 0:
+            if d.is_deleted:
+                continue
+            first_keepable = d.get_first_keepable()
+            if first_keepable > 0:
+                key = (-d.kept_total,
+                       -d.extra_total,
+                       -d.count_total,
+                       first_keepable,
+                       d.path)
+                if best is None or key < best_key:
+                    best, best_key = d, key
+
+        if best is None:
             return None
 
-        # print('calc_max(): filtered_list\n', pformat(filtered_list))
-        class reversor:
-            def __init__(self, obj):
-                self.obj = obj
-
-            def __eq__(self, other):
-                return other.obj == self.obj
-
-            def __lt__(self, other):
-                return other.obj < self.obj
-
-        # sort to find the best directory
-        sorted_arr = sorted(filtered_list,
-                            key=lambda d: (
-                                reversor(d.kept_total),
-                                reversor(d.extra_total),
-                                reversor(d.count_total),
-                                d.get_first_keepable(),
-                                d.path,
-                                # d.size,
-                                # # prefer shallower directory
-                                # d.parent[::-1],
-                                # reversor(d.path),
-                            ))# ,
-                            # reverse=True)
-        # print('calc_max(): sorted_arr\n', pformat(sorted_arr))
-
-
-        keepable = None
-        for d in sorted_arr:
-            dirs = d.get_keepable_dirs()
-            if dirs:
-                keepable = next(iter(dirs))
-                break
-
+        # get_first_keepable() > 0 guarantees get_keepable_dirs() is
+        # not empty, so the best candidate always has a keepable dir.
+        # print('calc_max(): best\n', best)
+        keepable = next(iter(best.get_keepable_dirs()))
         keepable = keepable.check_largest(dwd)
         # print('calc_max(): final_max\n', keepable)
         return keepable
@@ -329,9 +332,9 @@ class DupeDir(DupeFile):
         # print(f'check_largest(): self={self.path}')
         for ddp in self.dd_dupes:
             # print(f'check_largest(): dd1={ddp}')
-            if ddp not in checked and ddp in dwd:
+            dd = dwd.get(ddp) if ddp not in checked else None
+            if dd is not None:
                 checked.add(ddp)
-                dd = dwd[ddp]
                 # print(f'check_largest(): dd2={dd.path}')
                 if not dd.is_empty() and not dd.is_kept:
                     # print(f'check_largest(): dd3={dd.count} > {largest.count}')
@@ -346,6 +349,8 @@ class DupeDir(DupeFile):
     def check_delete(self):
         if not self.is_deleted and self.is_empty():
             self.is_deleted = True
+            for owner in self.owners:
+                owner.live_subdirs -= 1
         return self.is_deleted
 
     def decrement_dupes(self, df, dwd):
@@ -359,12 +364,12 @@ class DupeDir(DupeFile):
         next_parent = self.parent
         # sometimes we need to skip dirs
 
-        while next_parent != self.fs_root:
+        while next_parent != self.root_path:
             if next_parent in dwd:
                 dd = dwd[next_parent]
                 dd.decrement_dupes(df, dwd)
                 break
-            next_parent = FileUtil.parent(next_parent)
+            next_parent = FileUtil.dir_parent(next_parent)
 
     def increment_dupes(self, df, dwd):
         self.kept += 1
@@ -418,15 +423,10 @@ class DupeDir(DupeFile):
 
     def check_single_parent(self, da):
         # print('checking', self.path, self.parent)
-        ret = da.get_dir_info(self.parent)
-        filenames = ret['files']
-        dirs = ret['subdirs']
-        if len(filenames) == 0 and len(dirs) == 1:
-            full_path = dirs[0]
-            if full_path == self.path:
-                dd = DupeDir(self.parent, None)
-                dd.subdir_dupes.add(self)
-                return dd
+        if da.get_only_subdir(self.parent) == self.path:
+            dd = DupeDir(self.parent, None)
+            dd.add_subdir_dupe(self)
+            return dd
         return None
 
 
@@ -441,6 +441,9 @@ class DupeDedupe:
         self.exec_delete = args.delete
         self.analyze_only = args.analyze
         self.manual_db = args.manual
+        self.hash_name = args.hash
+        self.workers = args.workers
+        self.refresh = args.refresh
 
     def analyze(self):
         """Compare the two directories for duplicate files."""
@@ -451,7 +454,9 @@ class DupeDedupe:
         excludes = []
         if self.synology:
             excludes = ['*/@*', '*/.*']
-        da = DupeAnalysis(debug=self.debug, excludes=excludes)
+        da = DupeAnalysis(debug=self.debug, excludes=excludes,
+                          hash_name=self.hash_name, workers=self.workers,
+                          refresh=self.refresh)
         da.load(self.dirs, manual_db=self.manual_db)
 
         print(f"-------------------------------")
@@ -501,14 +506,15 @@ class DupeDedupe:
                 #     continue
                 obj_list = set()
                 for path in files:
-                    if path not in dupefiles:
+                    df = dupefiles.get(path)
+                    if df is None:
                         # print(f'\r\t  Processing: {parent}', end='')
                         df = DupeFile(path, hash,
                                       rev_hashes_by_size[path])
                         dupefiles[path] = df
                         obj_list.add(df)
 
-                    parent = dupefiles[path].parent
+                    parent = df.parent
                     # print('p', parent)
                     if parent not in dirs_w_dupes:
                         # print(f'\r\t  Processing: {parent}', end='')
@@ -522,8 +528,12 @@ class DupeDedupe:
                             dirs_w_dupes_by_depth[sp.depth].append(sp)
 
                 # set the duplicates
-                for df in obj_list:
-                    df.set_dupes(obj_list)
+                group = tuple(obj_list)
+                # includes each file's own parent, which check_largest()
+                #  never prefers over itself
+                group_dirs = frozenset(df.parent for df in group)
+                for df in group:
+                    df.set_dupes(group, group_dirs)
 
                 pbar.update(1)
 
@@ -586,16 +596,12 @@ class DupeDedupe:
         delete_lookup = {}
         # generate the first pass of dupe finding (hardest part)
         kept, kepts, dels = d.keep(final_output, delete_lookup, dirs_w_dupes)
-        reviewed = set()
-        reviewed.update(kepts)
-        reviewed.update(dels)
-
-        all_dupes = set()
-        all_dupes.update(dupefiles.values())
-        # pprint(all_dupes)
-
-        remaining_dupes = all_dupes - reviewed
-        # print('analyze()', pformat(all_dupes))
+        # shrink the remaining set in place after each pass instead of
+        #  rebuilding all dupes minus everything reviewed so far
+        remaining_dupes = set(dupefiles.values())
+        remaining_dupes.difference_update(kepts)
+        remaining_dupes.difference_update(dels)
+        # print('analyze()', pformat(remaining_dupes))
 
         # do more passes until dupes are all found
         with tqdm(total=len(remaining_dupes), unit='file',
@@ -624,11 +630,10 @@ class DupeDedupe:
 
 
                 kept, kepts, dels = d.keep(final_output, delete_lookup, dirs_w_dupes)
-                reviewed.update(kepts)
-                reviewed.update(dels)
+                remaining_dupes.difference_update(kepts)
+                remaining_dupes.difference_update(dels)
                 # print('pass ', debug_count)
                 pbar.update(len(kepts) + len(dels))
-                remaining_dupes = all_dupes - reviewed
 
         if remaining_dupes:
             print(f'Remaining dupes:\n{pformat(remaining_dupes)}')
@@ -659,17 +664,24 @@ class DupeDedupe:
                             # substitutions
                             if first_time:
                                 deletes.add(dd)
+                                # so our parent can find us like a file
+                                delete_lookup[dd.path] = kept
                                 first_time = False
                     # clean up subdirs that are children of deleted dirs
                     for sd in dd.subdir_dupes:
-                        for kept, vals in final_output.items():
-                            keeps, deletes, sizes = vals
-                            if sd in deletes:
-                                # print('found', sd.path, dd.path)
-                                deletes.remove(sd)
-                                if first_time:
-                                    deletes.add(dd)
-                                    first_time = False
+                        # a subdir is only in final_output if it was
+                        #  swapped in above, which recorded where
+                        kept = delete_lookup.get(sd.path)
+                        if kept is None:
+                            continue
+                        keeps, deletes, sizes = final_output[kept]
+                        if sd in deletes:
+                            # print('found', sd.path, dd.path)
+                            deletes.remove(sd)
+                            if first_time:
+                                deletes.add(dd)
+                                delete_lookup[dd.path] = kept
+                                first_time = False
                     # this has no files or subdirs
                     # if first_time:
                     #     print('first_time', dd.path)
@@ -736,6 +748,9 @@ if __name__ == "__main__":
     parser.add_argument('--synology', action='store_true', help="Ignores certain files/dirs on synology NAS (@dirs, .files).")
     parser.add_argument('--analyze', action='store_true', help="Only performs dupe analysis, not any recommendation.")
     parser.add_argument('--manual', metavar='DB', help="Analyze a specific directory.")
+    parser.add_argument('--hash', default='sha1', help="Content hash to use: any fixed-length hashlib algorithm (not shake_*), or blake3 if installed (default: sha1).")
+    parser.add_argument('--workers', type=int, help="Number of threads used to hash files, split between directories on different devices (default: CPU count).")
+    parser.add_argument('--refresh', action='store_true', help="Update a stored analysis with changed files instead of reusing it as is.")
 
     args = parser.parse_args()
 
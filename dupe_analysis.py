@@ -7,16 +7,40 @@ import fnmatch
 import re
 import subprocess
 import shutil
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from operator import itemgetter
 from tqdm import tqdm
 from pprint import pprint, pformat
 from dupe_utils import ProcessTimer
 
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 class DupeAnalysis:
     """Handles file hashing and analysis for directories, optimized with layered hashing."""
 
+    # bump when the way hashes are computed or stored changes so that
+    #  databases from older versions are rebuilt instead of reused
+    db_version = 6
+    # bytes read for each partial (beg/rev) hash
+    chunk_size = 1024
+    # files up to this size are hashed whole in the first pass
+    small_file_size = 64 * 1024
+    # read size for full file hashes
+    read_size = 1 << 20
+    # most rows handed to a hashing thread at once
+    task_size = 64
+    # reading a file for its hash shouldn't dirty its inode (Linux only)
+    o_noatime = getattr(os, 'O_NOATIME', 0)
+
     def __init__(self, debug=False, complete_hash=False,
                  db_root='dd_analysis',
-                 batch_limit=1000, excludes=[]):
+                 batch_limit=1000, excludes=[], hash_name='sha1',
+                 workers=None, refresh=False, position=None):
 
         self.paths = None
         self.db_root = os.path.abspath(db_root)
@@ -25,10 +49,17 @@ class DupeAnalysis:
         self.cursor = None
         self.debug = debug
         self.complete_hash = complete_hash
+        self.refresh = refresh
         self.excludes = excludes
         self.excl_re = re.compile(r'|'.join([fnmatch.translate(x)
                                   for x in excludes]) or r'$.')
-        self.zero_hash = 'da39a3ee5e6b4b0d3255bfef95601890afd80709'
+        self.hash_name = hash_name
+        self.hash = DupeAnalysis.get_hash_func(hash_name)
+        self.zero_hash = self.hash().digest()
+        self.workers = workers or os.cpu_count()
+        # terminal line for the progress bars, when several analyses
+        #  draw them at once
+        self.position = position
         self.batch_limit = batch_limit
         if self.debug:
             self.batch_limit = 2
@@ -36,19 +67,58 @@ class DupeAnalysis:
         os.makedirs(self.db_root, exist_ok=True)
 
     @staticmethod
-    def _get_db_path(directories, db_root):
+    def get_hash_func(hash_name):
+        """Returns a constructor for the named content hash."""
+        if hash_name == 'blake3':
+            if blake3 is None:
+                raise RuntimeError('blake3 hashing requires the blake3 '
+                                   'package (pip install blake3)')
+            return blake3.blake3
+        if hash_name not in hashlib.algorithms_available:
+            raise RuntimeError(f"unsupported hash: {hash_name}")
+        if hash_name.startswith('shake_'):
+            # digest() of a SHAKE needs an output length
+            raise RuntimeError(f"unsupported hash: {hash_name} "
+                               f"(variable-length digest)")
+        # the named constructors (hashlib.sha1, ...) go straight to the
+        #  OpenSSL digest and are about twice as quick as hashlib.new
+        ctor = getattr(hashlib, hash_name, None)
+        if ctor is None:
+            ctor = partial(hashlib.new, hash_name)
+        try:
+            template = ctor()
+        except ValueError:
+            # FIPS builds refuse legacy digests unless told they are not
+            #  used for security, which is true of content fingerprints
+            template = ctor(usedforsecurity=False)
+        # copying a fresh context skips the digest setup (about half
+        #  the cost of the constructor) for every file hashed
+        return template.copy
+
+    @staticmethod
+    def _get_db_path(directories, db_root, hash_name='sha1'):
         sorted_dirs = sorted(map(os.path.abspath, directories))
         hash_value = hashlib.sha1('|'.join(sorted_dirs).encode()).hexdigest()
+        # hashes from different algorithms can't be compared, so they
+        #  get their own databases (sha1 keeps the original name)
+        if hash_name != 'sha1':
+            hash_value = f"{hash_value}.{hash_name}"
         db_filename = f"{hash_value}.db"
         return os.path.join(db_root, db_filename)
 
     def _set_db_path(self):
-        self.db_path = self._get_db_path(self.paths, self.db_root)
+        self.db_path = self._get_db_path(self.paths, self.db_root,
+                                         self.hash_name)
 
     @staticmethod
     def _connect_db(db_path):
         conn = sqlite3.connect(db_path)
         cursor = conn.cursor()
+        # every batch is committed, and an interrupted analysis is simply
+        #  re-run, so fewer fsyncs per commit are fine; the journal mode
+        #  is left alone since WAL doesn't work on network filesystems
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.execute("PRAGMA temp_store = MEMORY")
         return conn, cursor
 
     @staticmethod
@@ -62,9 +132,11 @@ class DupeAnalysis:
             dirpath TEXT,
             name TEXT,
             size INTEGER,
-            beg_hash TEXT,
-            rev_hash TEXT,
-            full_hash TEXT
+            mtime INTEGER,
+            inode INTEGER,
+            beg_hash BLOB,
+            rev_hash BLOB,
+            full_hash BLOB
         );
 
         CREATE TABLE IF NOT EXISTS dirs (
@@ -87,29 +159,74 @@ class DupeAnalysis:
 
         CREATE INDEX IF NOT EXISTS idx_dirs_dirpath ON dirs(dirpath);
         """)
+        cursor.execute(f"PRAGMA user_version = {DupeAnalysis.db_version}")
         conn.commit()
         return conn, cursor
 
     @staticmethod
-    def _exists(dirs, db_root):
-        db_path = DupeAnalysis._get_db_path(dirs, db_root)
+    def _get_db_version(db_path):
+        # a plain connection, so probing a database changes nothing in it
+        conn = sqlite3.connect(db_path)
+        try:
+            return conn.execute("PRAGMA user_version").fetchone()[0]
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _move_aside(db_path, version):
+        """
+        Rename an outdated database to <name>.v<version>.bak (plus a
+        counter if that is taken) so its analysis isn't thrown away.
+        """
+        bak_path = f"{db_path}.v{version}.bak"
+        count = 0
+        while os.path.exists(bak_path):
+            count += 1
+            bak_path = f"{db_path}.v{version}.{count}.bak"
+        os.replace(db_path, bak_path)
+        return bak_path
+
+    @staticmethod
+    def _exists(dirs, db_root, hash_name='sha1'):
+        db_path = DupeAnalysis._get_db_path(dirs, db_root, hash_name)
         exists = os.path.exists(db_path)
+        if exists:
+            version = DupeAnalysis._get_db_version(db_path)
+            if version != DupeAnalysis.db_version:
+                # hashes in an older database aren't comparable to ours,
+                #  so analyze again but keep the old file around
+                bak_path = DupeAnalysis._move_aside(db_path, version)
+                print(f"\tMoved outdated database {db_path} "
+                      f"(version {version}, need {DupeAnalysis.db_version}) "
+                      f"to {bak_path}")
+                exists = False
         return (exists, db_path)
 
     def load(self, dirs, manual_db=None):
         if manual_db:
+            if not os.path.exists(manual_db):
+                raise RuntimeError(f"database {manual_db} does not exist")
+            version = DupeAnalysis._get_db_version(manual_db)
+            if version != DupeAnalysis.db_version:
+                raise RuntimeError(
+                    f"database {manual_db} is version {version}, this "
+                    f"version of the tool needs {DupeAnalysis.db_version}; "
+                    f"analyze the directories again to rebuild it")
             self.paths = dirs
             db_path = manual_db
             exists = True
         else:
             self.paths = {os.path.abspath(dir) for dir in dirs}
-            exists, db_path = DupeAnalysis._exists(self.paths, self.db_root)
+            exists, db_path = DupeAnalysis._exists(self.paths, self.db_root,
+                                                   self.hash_name)
 
         print(f"Attempting load of {self.paths}")
         if exists:
             self.db_path = db_path
             print(f"\tLoading existing database for {self.paths} from {self.db_path}")
             self.conn, self.cursor = DupeAnalysis._connect_db(self.db_path)
+            if self.refresh:
+                self._refresh()
             return
         else:
             # base case: do analysis
@@ -131,7 +248,8 @@ class DupeAnalysis:
                     found = set()
                     for comb in combs:
                         sc = set(comb)
-                        exists, db_path = DupeAnalysis._exists(sc, self.db_root)
+                        exists, db_path = DupeAnalysis._exists(
+                            sc, self.db_root, self.hash_name)
                         if exists:
                             dbs_found[db_path] = sc
                             found = sc
@@ -139,25 +257,94 @@ class DupeAnalysis:
                     paths_not_loaded = paths_not_loaded - found
                     path_count -= 1
 
+                if self.refresh:
+                    # only databases that were loaded can be stale; the
+                    #  ones built below walk their paths anyway
+                    for sc in dbs_found.values():
+                        da = self._sub_analysis(refresh=True)
+                        da.load(sc)
+                        da.close()
+
                 # print('paths_not_loaded', pformat(paths_not_loaded))
                 # create new ones if there are still some not found
                 # we only do one at a time so we can combine results easily
                 if paths_not_loaded:
+                    # paths on different devices are analyzed at the same
+                    #  time; paths sharing a disk take turns so their
+                    #  reads don't fight over it
+                    by_device = defaultdict(list)
                     for path in paths_not_loaded:
-                        # print('path', path)
-                        sp = set()
-                        sp.add(path)
-                        da = DupeAnalysis(self.debug, complete_hash=self.complete_hash, db_root=self.db_root, excludes=self.excludes)
-                        da.load(sp)
-                        da.close()
-                        dbs_found[da.db_path] = sp
+                        by_device[DupeAnalysis._device(path)].append(path)
+                    workers = max(1, self.workers // len(by_device))
+                    analyze_paths = partial(self._analyze_paths,
+                                            workers=workers)
+                    # each device draws its bars on its own line
+                    positions = (range(len(by_device))
+                                 if len(by_device) > 1
+                                 else [self.position])
+                    with ThreadPoolExecutor(
+                            max_workers=len(by_device)) as executor:
+                        for found in executor.map(analyze_paths,
+                                                  by_device.values(),
+                                                  positions):
+                            dbs_found.update(found)
 
                 # print('dbs_found', pformat(dbs_found))
                 # add in all of the found paths
                 self._merge(dbs_found)
 
+    def _sub_analysis(self, **kwargs):
+        """An analysis of some of self.paths with the same settings."""
+        kwargs.setdefault('workers', self.workers)
+        return DupeAnalysis(self.debug, complete_hash=self.complete_hash, db_root=self.db_root, excludes=self.excludes, hash_name=self.hash_name, **kwargs)
+
+    def _analyze_paths(self, paths, position=None, workers=None):
+        """
+        Helper function to load() which builds a database for each path
+        in turn, returning {db_path: {path}}.
+        """
+        found = {}
+        for path in paths:
+            # print('path', path)
+            sp = set()
+            sp.add(path)
+            da = self._sub_analysis(workers=workers, position=position)
+            da.load(sp)
+            da.close()
+            found[da.db_path] = sp
+        return found
+
+    @staticmethod
+    def _device(path):
+        try:
+            return os.stat(path).st_dev
+        except OSError:
+            return None
 
-    def analyze(self, batch_limit=1000):
+    def _refresh(self):
+        """
+        Bring an existing database up to date with the file system.
+        Files whose size, mtime and inode are unchanged keep their hashes.
+        """
+        print(f"Refreshing: {self.paths}")
+        known = {}
+        for fid, path, size, mtime, inode in self.cursor.execute(
+                "SELECT id, path, size, mtime, inode FROM files"):
+            known[path] = (fid, (size, mtime, inode))
+        # the directory tables are cheap to rebuild from the walk
+        self.cursor.execute("DELETE FROM dirs")
+        self.cursor.execute("DELETE FROM empty_dirs")
+        self.conn.commit()
+        self.analyze(batch_limit=self.batch_limit, known=known)
+
+
+    def analyze(self, batch_limit=1000, known=None):
+        """
+        Walk self.paths into the database and hash the candidates.
+        known maps path -> (id, (size, mtime, inode)) of rows already in
+        the database; those that are unchanged are skipped, changed ones
+        are replaced and any that are no longer found are removed.
+        """
         print(f"Analyzing: {self.paths}")
         timer = ProcessTimer(start=True)
 
@@ -169,32 +356,41 @@ class DupeAnalysis:
         batch_db_calls = batch_limit > 1
         with tqdm(total=total_size,
                   unit='B', unit_scale=True, unit_divisor=1024,
-                  ncols=80, desc="\t[Pass 0] load filesizes") as pbar:
+                  ncols=80, desc="\t[Pass 0] load filesizes",
+                  position=self.position) as pbar:
             for path in self.paths:
-                for root, dirs, files in os.walk(path):
+                for root, dirs, files in DupeAnalysis.walk(path):
                     filtered_files = []
-                    for fname in files:
+                    for fname, path, file_size, mtime, inode in files:
                         depth = fname.count(os.sep)
-                        path = os.path.join(root, fname)
                         # exclude files
                         if self.excl_re.match(path):
                             continue
                         filtered_files.append(path)
-                        try:
-                            file_size = os.path.getsize(path)
-                        except OSError:
-                            file_size = -1
+
+                        if known is not None and path in known:
+                            # a new inode catches files replaced by one
+                            #  with the same size and mtime (cp -p, rsync)
+                            fid, stamp = known.pop(path)
+                            if stamp == (file_size, mtime, inode):
+                                pbar.update(file_size)
+                                continue
+                            # changed: replace the row so it gets rehashed
+                            self.cursor.execute(
+                                "DELETE FROM files WHERE id = ?", (fid,))
 
                         if batch_db_calls:
                             if file_size == 0:
                                 batch_fs_empty.append((path,
                                                    depth,
                                                    root,
-                                                   fname))
+                                                   fname,
+                                                   mtime, inode))
                             else:
                                 batch_fs.append((path, depth,
                                               root,
-                                              fname, file_size))
+                                              fname, file_size, mtime,
+                                              inode))
                             if len(batch_fs) >= batch_limit:
                                 self._insert_files_batch(batch_fs)
                                 batch_fs = []
@@ -204,11 +400,11 @@ class DupeAnalysis:
                                 self._insert_files_empty_batch(batch_fs_empty)
                                 batch_fs_empty = []
                         else:
-                            self._insert_file(path, depth, root, fname, file_size)
+                            self._insert_file(path, depth, root, fname,
+                                              file_size, mtime, inode)
                         pbar.update(file_size)
 
                     # exclude dirs
-                    dirs[:] = [os.path.join(root, d) for d in dirs]
                     dirs[:] = [d for d in dirs
                                if not self.excl_re.match(d)]
                     if dirs:
@@ -241,9 +437,86 @@ class DupeAnalysis:
             if batch_ds_empty:
                 self._insert_dirs_empty(batch_ds_empty)
 
+        if known:
+            # whatever is left in known was not found by the walk
+            self.cursor.executemany("DELETE FROM files WHERE id = ?",
+                                    [(fid,) for fid, _ in known.values()])
+            self.conn.commit()
+
         self._compute_hashes()
         print(f"\tTotal Analysis Time: {timer.elapsed_readable()}")
 
+    @staticmethod
+    def walk(top):
+        """
+        Like os.walk(top) but built on os.scandir so each file comes with
+        its stat from the DirEntry, as (name, path, size, mtime_ns, inode)
+        tuples, and dirs are full paths. Prune by editing dirs in place.
+        """
+        stack = [top]
+        while stack:
+            root = stack.pop()
+            try:
+                scandir_it = os.scandir(root)
+            except OSError:
+                continue
+
+            dirs = []
+            files = []
+            links = set()
+            failed = False
+            with scandir_it:
+                while True:
+                    try:
+                        entry = next(scandir_it)
+                    except StopIteration:
+                        break
+                    except OSError:
+                        # like os.walk, skip a directory whose listing
+                        #  fails part way (EIO, stale NFS handle, ...)
+                        failed = True
+                        break
+
+                    try:
+                        is_dir = entry.is_dir()
+                    except OSError:
+                        is_dir = False
+
+                    if is_dir:
+                        dirs.append(entry.path)
+                        # like os.walk, list dir symlinks but don't follow
+                        try:
+                            if entry.is_symlink():
+                                links.add(entry.path)
+                        except OSError:
+                            pass
+                    else:
+                        try:
+                            if entry.is_symlink():
+                                # a linked file is content of its dir, but
+                                #  not a copy whose deletion frees anything,
+                                #  so like unreadable files it is never
+                                #  hashed
+                                st = entry.stat(follow_symlinks=False)
+                                size = -1
+                            else:
+                                st = entry.stat()
+                                size = st.st_size
+                            mtime = st.st_mtime_ns
+                            inode = st.st_ino
+                        except OSError:
+                            size = -1
+                            mtime = inode = None
+                        files.append((entry.name, entry.path, size, mtime,
+                                      inode))
+            if failed:
+                continue
+
+            yield root, dirs, files
+
+            # reversed so subdirs are visited in listing order
+            stack.extend(d for d in reversed(dirs) if d not in links)
+
     def _get_total_size(self):
         if platform.system() == "Windows":
             return self._get_total_size_windows()
@@ -318,32 +591,33 @@ class DupeAnalysis:
 
         return total_size
 
-    def _insert_file(self, path, depth, dirpath, name, size):
+    def _insert_file(self, path, depth, dirpath, name, size, mtime, inode):
         self.cursor.execute("""
-            INSERT INTO files (path, depth, dirpath, name, size)
-            VALUES (?, ?, ?, ?, ?)
-        """, (path, depth, dirpath, name, size))
+            INSERT INTO files (path, depth, dirpath, name, size, mtime, inode)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (path, depth, dirpath, name, size, mtime, inode))
         self.conn.commit()
 
     def _insert_files_batch(self, batch):
         self.cursor.executemany("""
-            INSERT INTO files (path, depth, dirpath, name, size)
-            VALUES (?, ?, ?, ?, ?)
+            INSERT INTO files (path, depth, dirpath, name, size, mtime, inode)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
         """, batch)
         self.conn.commit()
 
     def _insert_files_empty_batch(self, batch_zero):
-        self.cursor.executemany(f"""
-            INSERT INTO files (path, depth, dirpath, name, size, beg_hash, rev_hash, full_hash)
-            VALUES (?, ?, ?, ?, 0, '{self.zero_hash}', '{self.zero_hash}', '{self.zero_hash}')
-        """, batch_zero)
+        zero = (self.zero_hash,) * 3
+        self.cursor.executemany("""
+            INSERT INTO files (path, depth, dirpath, name, size, mtime, inode, beg_hash, rev_hash, full_hash)
+            VALUES (?, ?, ?, ?, 0, ?, ?, ?, ?, ?)
+        """, (row + zero for row in batch_zero))
         self.conn.commit()
 
     def _insert_dirs(self, path, dirs):
-        new_dirs = [(d,) for d in dirs]
-        self.cursor.executemany(f"""
+        new_dirs = [(path, d) for d in dirs]
+        self.cursor.executemany("""
             INSERT INTO dirs (dirpath, subdir)
-            VALUES ('{path}', ?)
+            VALUES (?, ?)
         """, new_dirs)
         self.conn.commit()
 
@@ -351,7 +625,7 @@ class DupeAnalysis:
         all_inserts = []
         for p, ds in batch_ds:
             all_inserts.extend([(p, d) for d in ds])
-        self.cursor.executemany(f"""
+        self.cursor.executemany("""
             INSERT INTO dirs (dirpath, subdir)
             VALUES (?, ?)
         """, all_inserts)
@@ -374,99 +648,202 @@ class DupeAnalysis:
         if self.complete_hash:
             self._compute_hash('rev_hash', 'full_hash',
                                '[Pass 3] full file hash')
+    def _hash_row(self, position, row):
+        fid, size, path = row
+        if position == 'beg_hash' and size <= self.small_file_size:
+            # reading a small file whole costs about the same as its
+            #  first chunk, and then no later pass has to reopen it
+            position = 'full_hash'
+        return DupeAnalysis.get_hash(path, size, position,
+                                     chunk=self.chunk_size,
+                                     hash=self.hash)
+
+    def _hash_rows(self, position, rows):
+        return [self._hash_row(position, row) for row in rows]
+
     def _compute_hash(self, old, new, msg):
         self.cursor.execute(
             DupeAnalysis._generate_hash_sql(old, new))
         rows = self.cursor.fetchall()
-        with tqdm(total=len(rows), unit='file', unit_scale=True,
-                  ncols=80, desc=f"\t{msg}") as pbar:
-
-            for row in rows:
-                fid, size, path = row
+        all_positions = ('beg_hash', 'rev_hash', 'full_hash')
+        hash_rows = partial(self._hash_rows, new)
+        # file reads and hashlib release the GIL, so hash on a pool
+        #  and keep all the database writes on this thread
+        with ThreadPoolExecutor(max_workers=self.workers) as executor, \
+             tqdm(total=len(rows), unit='file', unit_scale=True,
+                  ncols=80, desc=f"\t{msg}",
+                  position=self.position) as pbar:
+
+            # a pool task per file costs more than hashing a small file,
+            #  so hand out runs of rows; a few per worker still keeps the
+            #  threads even when the files are big
+            step = max(1, min(self.task_size,
+                              min(len(rows), self.batch_limit)
+                              // (self.workers * 4)))
+            # all runs are queued up front so the pool keeps hashing
+            #  while finished batches are written
+            hashes = itertools.chain.from_iterable(executor.map(
+                hash_rows, [rows[i:i + step]
+                            for i in range(0, len(rows), step)]))
+            batch = []
+            batch_small = []
+            for (fid, size, path), hash in zip(rows, hashes):
                 # print(path, size, new)
-                hash = DupeAnalysis.get_hash(path, size, new)
-                self._update_file_hashes(fid, hash, new)
+                if new == 'beg_hash' and size <= self.small_file_size:
+                    # small files were hashed whole, so this is also
+                    #  their rev/full hash and later passes skip them
+                    batch_small.append((hash, hash, hash, fid))
+                    if len(batch_small) >= self.batch_limit:
+                        self._update_file_hashes_batch(batch_small,
+                                                       all_positions)
+                        batch_small = []
+                else:
+                    batch.append((hash, fid))
+                    if len(batch) >= self.batch_limit:
+                        self._update_file_hashes_batch(batch, (new,))
+                        batch = []
                 pbar.update(1)
 
+            if batch:
+                self._update_file_hashes_batch(batch, (new,))
+            if batch_small:
+                self._update_file_hashes_batch(batch_small, all_positions)
+
     @staticmethod
     def _generate_hash_sql(old, new):
+        # files of different sizes can share sampled hashes, so a hash
+        #  only counts as a collision between files of the same size
+        group = old if old == 'size' else f"{old}, size"
         return f"""
         SELECT id, size, path
         FROM files
-        WHERE {old}
+        WHERE ({group})
         IN
         (
-        SELECT {old}
+        SELECT {group}
         FROM files
         WHERE {old} IS NOT NULL
         AND size > 0
-        GROUP BY {old}
+        GROUP BY {group}
         HAVING COUNT(id) > 1
         )
         AND {new} IS NULL
         """
 
-    def _update_file_hashes(self, fid, hash, position):
-        # print(fid, hash, position)
-        sql = f"""
-        UPDATE files
-        SET {position} = '{hash}'
-        WHERE id = {fid}
-        """
-        # print(sql)
-        self.cursor.execute(sql)
+    def _update_file_hashes_batch(self, batch, positions):
+        # batch rows are (hash per position..., fid)
+        sets = ', '.join(f"{position} = ?" for position in positions)
+        self.cursor.executemany(f"""
+            UPDATE files
+            SET {sets}
+            WHERE id = ?
+        """, batch)
         self.conn.commit()
 
     @staticmethod
     def chunk_reader(fobj, chunk_size):
-        """Generator that reads a file in chunks of bytes."""
+        """
+        Generator that reads a file in chunks of bytes into one reused
+        buffer. Each chunk is a memoryview that is only valid until the
+        next one is read.
+        """
+        buf = bytearray(chunk_size)
+        view = memoryview(buf)
         while True:
-            chunk = fobj.read(chunk_size)
-            if not chunk:
+            n = fobj.readinto(buf)
+            if not n:
                 return
-            yield chunk
+            yield view[:n]
+
+    @staticmethod
+    def open_noatime(filename, flags):
+        """
+        os.open() that also asks not to update the access time, usable as
+        an opener for open(). Falls back to a plain open for files the
+        user doesn't own, which the kernel refuses O_NOATIME for.
+        """
+        if DupeAnalysis.o_noatime:
+            try:
+                return os.open(filename, flags | DupeAnalysis.o_noatime)
+            except PermissionError:
+                pass
+        return os.open(filename, flags)
+
+    @staticmethod
+    def read_chunks(filename, offsets, chunk_size):
+        """Read chunk_size bytes at each offset with a single open."""
+        if hasattr(os, 'pread'):
+            # raw fd + pread: no buffered reader, no seeks
+            fd = DupeAnalysis.open_noatime(filename, os.O_RDONLY)
+            try:
+                return [os.pread(fd, chunk_size, offset)
+                        for offset in offsets]
+            finally:
+                os.close(fd)
+
+        # no pread on Windows
+        chunks = []
+        with open(filename, 'rb', opener=DupeAnalysis.open_noatime) as f:
+            for offset in offsets:
+                f.seek(offset)
+                chunks.append(f.read(chunk_size))
+        return chunks
 
     @staticmethod
     def get_hash(filename, filesize, position,
                  chunk=1024, hash=hashlib.sha1):
         if filesize == 0:
-            return self.zero_hash
+            return hash().digest()
 
         hashobj = hash()
         try:
-            with open(filename, 'rb') as f:
-                if position == 'beg_hash':
-                    hashobj.update(f.read(chunk))
-                elif position == 'rev_hash':
-                    f.seek(max(0, filesize - chunk))
-                    hashobj.update(f.read(chunk))
-                    f.seek(max(0, filesize // 2 - chunk // 2))
-                    hashobj.update(f.read(chunk))
-                elif position == 'full_hash':
-                    for chunk in DupeAnalysis.chunk_reader(f, chunk):
-                        hashobj.update(chunk)
-                else:
-                    raise Exception('invalid position')
+            if position == 'beg_hash':
+                offsets = (0,)
+            elif position == 'rev_hash':
+                offsets = (max(0, filesize - chunk),
+                           max(0, filesize // 2 - chunk // 2))
+            elif position == 'full_hash':
+                offsets = None
+            else:
+                raise Exception('invalid position')
+
+            if offsets is None:
+                # unbuffered so readinto fills our buffer directly
+                read_size = min(filesize, DupeAnalysis.read_size)
+                with open(filename, 'rb', buffering=0,
+                          opener=DupeAnalysis.open_noatime) as f:
+                    if filesize > read_size and hasattr(os, 'posix_fadvise'):
+                        # widen the kernel's readahead for the stream
+                        os.posix_fadvise(f.fileno(), 0, 0,
+                                         os.POSIX_FADV_SEQUENTIAL)
+                    for data in DupeAnalysis.chunk_reader(f, read_size):
+                        hashobj.update(data)
+            else:
+                for data in DupeAnalysis.read_chunks(filename, offsets,
+                                                     chunk):
+                    hashobj.update(data)
         except OSError:
             return None
-        return hashobj.hexdigest()
+        return hashobj.digest()
 
     def _copy_data(self, source_db_path):
-        conn, cursor = DupeAnalysis._connect_db(source_db_path)
-        cursor.execute("SELECT path, depth, dirpath, name, size, beg_hash, rev_hash, full_hash FROM files")
-        for row in cursor.fetchall():
+        # attach the source so sqlite copies the rows itself, without
+        #  each one passing through Python
+        self.cursor.execute("ATTACH DATABASE ? AS src", (source_db_path,))
+        try:
             self.cursor.execute("""
-                INSERT OR IGNORE INTO files (path, depth, dirpath, name, size, beg_hash, rev_hash, full_hash)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, row)
-        cursor.execute("SELECT path FROM empty_dirs")
-        for row in cursor.fetchall():
-            self.cursor.execute("INSERT OR IGNORE INTO empty_dirs (path) VALUES (?)", row)
-
-        cursor.execute("SELECT dirpath, subdir FROM dirs")
-        for row in cursor.fetchall():
-            self.cursor.execute("INSERT OR IGNORE INTO dirs (dirpath, subdir) VALUES (?, ?)", row)
-        conn.close()
+                INSERT OR IGNORE INTO files (path, depth, dirpath, name, size, mtime, inode, beg_hash, rev_hash, full_hash)
+                SELECT path, depth, dirpath, name, size, mtime, inode, beg_hash, rev_hash, full_hash FROM src.files
+            """)
+            self.cursor.execute("INSERT OR IGNORE INTO empty_dirs (path) SELECT path FROM src.empty_dirs")
+            self.cursor.execute("INSERT OR IGNORE INTO dirs (dirpath, subdir) SELECT dirpath, subdir FROM src.dirs")
+            self.conn.commit()
+        except BaseException:
+            # DETACH isn't allowed while the copy is still open
+            self.conn.rollback()
+            raise
+        finally:
+            self.cursor.execute("DETACH DATABASE src")
 
     def _merge(self, dbs_found):
         """
@@ -488,7 +865,6 @@ class DupeAnalysis:
         for db_path, dirs in dbs_found.items():
             print(f"\t{dirs} from {db_path}")
             self._copy_data(db_path)
-            self.conn.commit()
 
         print(f"Recomputing hashes for merged data")
         self._compute_hashes()
@@ -508,7 +884,7 @@ class DupeAnalysis:
 
         # Fetch files
         for row in self.cursor.execute("""
-        SELECT path, depth, dirpath, name, size, beg_hash, rev_hash, full_hash
+        SELECT path, depth, dirpath, name, size, mtime, inode, beg_hash, rev_hash, full_hash
         FROM files
         ORDER BY path ASC
             """):
@@ -518,9 +894,11 @@ class DupeAnalysis:
                 "dirpath": row[2],
                 "name": row[3],
                 "size": row[4],
-                "beg_hash": row[5],
-                "rev_hash": row[6],
-                "full_hash": row[7],
+                "mtime": row[5],
+                "inode": row[6],
+                "beg_hash": row[7] and row[7].hex(),
+                "rev_hash": row[8] and row[8].hex(),
+                "full_hash": row[9] and row[9].hex(),
             })
 
         # Fetch empty directories
@@ -542,23 +920,31 @@ class DupeAnalysis:
         # GROUP BY {hash}
         # HAVING COUNT(id) > 1
         # """)
+        # rows come ordered by group and are split up here, so paths
+        #  can hold any character (GROUP_CONCAT needed a separator)
         self.cursor.execute(f"""
-        SELECT {hash},
-        GROUP_CONCAT(path || '::' || size, '||')
+        SELECT {hash}, size, path
+        FROM files
+        WHERE ({hash}, size)
+        IN
+        (
+        SELECT {hash}, size
         FROM files
         WHERE {hash} IS NOT NULL
-        GROUP BY {hash}
+        GROUP BY {hash}, size
         HAVING COUNT(id) > 1
+        )
+        ORDER BY {hash}, size, id
         """)
-        for row in self.cursor.fetchall():
+        # equal hashes of different sizes are separate groups
+        for key, rows in itertools.groupby(self.cursor,
+                                           key=itemgetter(0, 1)):
+            size = key[1]
             paths = []
-            # print('row', row[1])
-            for r in row[1].split('||'):
-                # print('r', r)
-                path, size = r.split('::')
-                paths.append(path)
-                sizes[path] = int(size)
-            duplicates[row[0]] = paths
+            for row in rows:
+                paths.append(row[2])
+                sizes[row[2]] = size
+            duplicates[key] = paths
         return duplicates, sizes
 
     def get_dir_info(self, directory):
@@ -583,6 +969,32 @@ class DupeAnalysis:
         # print(f"get_dir_info(): {depth}, {directory}\n{pformat({'files': files, 'subdirs': subdirs})}")
         return {'files': files, 'subdirs': subdirs}
 
+    def get_only_subdir(self, directory):
+        """
+        Returns the subdir of directory if it is all the directory holds
+        (no files and a single subdir), else None. Unlike get_dir_info
+        this stops at the first file or second subdir.
+        """
+        self.cursor.execute("""
+        SELECT 1
+        FROM files
+        WHERE dirpath = ?
+        LIMIT 1
+        """, (directory,))
+        if self.cursor.fetchone():
+            return None
+
+        self.cursor.execute("""
+        SELECT subdir
+        FROM dirs
+        WHERE dirpath = ?
+        LIMIT 2
+        """, (directory,))
+        subdirs = self.cursor.fetchall()
+        if len(subdirs) != 1:
+            return None
+        return subdirs[0][0]
+
     # def get_dir_info(self, directory):
     #     dir_len = len(directory)
     #     self.cursor.execute(f"""
@@ -1,6 +1,7 @@
 import os
 import shutil
 from datetime import datetime
+from functools import lru_cache
 
 class FileUtil:
     @staticmethod
@@ -13,12 +14,29 @@ class FileUtil:
 
     @staticmethod
     def parent(path):
+        head, sep, _ = path.rpartition(os.sep)
+        if head and head[-1] != sep and not os.altsep:
+            # what dirname returns for normalized paths, minus the
+            #  general handling of roots, drives and repeated seps
+            return head
         return os.path.dirname(path)
 
+    @staticmethod
+    @lru_cache(maxsize=1 << 16)
+    def dir_parent(path):
+        # the parent walks in deduplicate.py ask for the same directories
+        #  over and over; file paths never repeat, so only cache these
+        return FileUtil.parent(path)
+
     @staticmethod
     def splitpath(path):
         return path.split(os.sep)
 
+    @staticmethod
+    def depth(path):
+        # same as len(splitpath(path)) without building the list
+        return path.count(os.sep) + 1
+
     @staticmethod
     def joinpath(parts):
         return os.sep.join(parts)
@@ -50,18 +68,16 @@ class FileUtil:
     def size(path):
         return os.path.getsize(path)
 
+    size_units = ('B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB')
+
     @staticmethod
     def human_readable(size):
-        # Define the units
-        units = ['B', 'KB', 'MB', 'GB', 'TB', 'PB', 'EB', 'ZB', 'YB']
-
-        # Initialize the index for units
-        unit_index = 0
-
-        # Loop to find the appropriate unit
-        while size >= 1024 and unit_index < len(units) - 1:
-            size /= 1024.0
-            unit_index += 1
+        # each unit is 1024 times the last, so the bit length of the
+        #  size picks the unit without dividing in a loop
+        units = FileUtil.size_units
+        unit_index = min(max(0, (int(size).bit_length() - 1) // 10),
+                         len(units) - 1)
+        size /= 1 << (10 * unit_index)
 
         # Return the formatted string
         return f"{size:.2f} {units[unit_index]}"
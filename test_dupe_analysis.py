@@ -1,8 +1,11 @@
+import errno
 import os
 import random
 from pathlib import Path
 import shutil
+import sqlite3
 import unittest
+from unittest import mock
 from pprint import pprint, pformat
 from dupe_analysis import DupeAnalysis
 
@@ -194,11 +197,12 @@ class TestDupeAnalysis(unittest.TestCase):
         # self.assertEqual(a-e, set(), f"\nextra: {pformat(a-e)}")
         # self.assertEqual(e-a, set(), f"\nmissing:{pformat(e-a)}")
 
-    def execute_default(self, dirs, complete_hash, excludes):
+    def execute_default(self, dirs, complete_hash, excludes, hash_name):
         analysis = DupeAnalysis(debug=self.debug,
                                 complete_hash=complete_hash,
                                 db_root=self.db_root,
-                                excludes=excludes)
+                                excludes=excludes,
+                                hash_name=hash_name)
         analysis.load(dirs)
         rets = analysis.get_duplicates()
         # pprint(analysis.dump_db())
@@ -206,18 +210,20 @@ class TestDupeAnalysis(unittest.TestCase):
         analysis.close()
         return rets['dupes']
 
-    def execute_merge(self, dirs1, dirs2, complete_hash, excludes):
+    def execute_merge(self, dirs1, dirs2, complete_hash, excludes, hash_name):
         analysis1 = DupeAnalysis(debug=self.debug,
                                  complete_hash=complete_hash,
                                  db_root=self.db_root,
-                                 excludes=excludes)
+                                 excludes=excludes,
+                                 hash_name=hash_name)
         analysis1.load(dirs1)
         # pprint(analysis1.dump_db())
         analysis1.close()
         analysis2 = DupeAnalysis(debug=self.debug,
                                  complete_hash=complete_hash,
                                  db_root=self.db_root,
-                                 excludes=excludes)
+                                 excludes=excludes,
+                                 hash_name=hash_name)
         dirs1.extend(dirs2)
         analysis2.load(dirs1)
         # pprint(analysis2.dump_db())
@@ -226,7 +232,7 @@ class TestDupeAnalysis(unittest.TestCase):
         analysis2.close()
         return rets['dupes']
 
-    def execute(self, input, expected, dirs, input2=None, dirs2=None, complete_hash=False, excludes=[]):
+    def execute(self, input, expected, dirs, input2=None, dirs2=None, complete_hash=False, excludes=[], hash_name='sha1'):
         print(f"\n==={self.func()}===================================================================")
         self.generate_file_structure(input)
         dirs = [os.path.join(self.test_root, d) for d in dirs]
@@ -235,11 +241,13 @@ class TestDupeAnalysis(unittest.TestCase):
             dirs2 = [os.path.join(self.test_root, d) for d in dirs2]
             actual = self.execute_merge(dirs, dirs2,
                                         complete_hash=complete_hash,
-                                        excludes=excludes)
+                                        excludes=excludes,
+                                        hash_name=hash_name)
         else:
             actual = self.execute_default(dirs,
                                           complete_hash=complete_hash,
-                                          excludes=excludes)
+                                          excludes=excludes,
+                                          hash_name=hash_name)
         print('\n======================================================================')
         self.validate_duplicates(actual, expected)
 
@@ -264,6 +272,49 @@ class TestDupeAnalysis(unittest.TestCase):
 
         self.execute(input, expected, dirs)
 
+    def test_symlinked_file(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder2/file2.txt',
+        ]
+        self.generate_file_structure(input)
+        os.symlink(os.path.join(self.test_root, 'folder2/file2.txt'),
+                   os.path.join(self.test_root, 'folder1/link2.txt'))
+
+        expected = [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+        ]
+
+        dirs = [os.path.join(self.test_root, d)
+                for d in ('folder1', 'folder2')]
+        actual = self.execute_default(dirs, complete_hash=False,
+                                      excludes=[], hash_name='sha1')
+        self.validate_duplicates(actual, expected)
+
+    def test_separator_in_name(self):
+        input = [
+            'folder1/file1a||x.txt',
+            'folder1/file1b||x.txt==folder1/file1a||x.txt',
+            'folder1/file2.txt',
+        ]
+
+        expected = [
+            [
+                'folder1/file1a||x.txt',
+                'folder1/file1b||x.txt',
+                ],
+        ]
+
+        dirs = [
+            'folder1'
+        ]
+
+        self.execute(input, expected, dirs)
+
     def test_different_sizes(self):
         input = [
             'folder1/file1a.txt:3KB',
@@ -293,6 +344,80 @@ class TestDupeAnalysis(unittest.TestCase):
 
         self.execute(input, expected, dirs)
 
+    def test_different_sizes_same_samples(self):
+        input = [
+            'folder1/file1a.txt:100KB',
+            'folder1/file1b.txt==folder1/file1a.txt:100KB',
+            'folder1/pad1.txt:50688B',
+            # 2KB longer than file1a, with its beginning, middle and end
+            #  chunks at the offsets sampled for this size
+            'folder1/file1c.txt==folder1/file1a.txt:1KB+folder1/pad1.txt:50688B+folder1/file1a.txt:50688B-51712B+folder1/pad1.txt:50688B+folder1/file1a.txt:99KB-100KB',
+            'folder1/file1d.txt==folder1/file1c.txt:102KB',
+        ]
+
+        expected = [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+            [
+                'folder1/file1c.txt',
+                'folder1/file1d.txt',
+                ],
+        ]
+
+        dirs = [
+            'folder1'
+        ]
+
+        self.execute(input, expected, dirs)
+
+    def test_small_files(self):
+        input = [
+            'folder1/file1a.txt:100B',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder1/file2.txt:100B',
+            'folder1/file3a.txt:1KB',
+            'folder1/file3b.txt==folder1/file3a.txt',
+        ]
+
+        expected = [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+            [
+                'folder1/file3a.txt',
+                'folder1/file3b.txt',
+                ],
+        ]
+
+        dirs = [
+            'folder1'
+        ]
+
+        self.execute(input, expected, dirs)
+
+    def test_small_files_complete_hash(self):
+        input = [
+            'folder1/file1a.txt:100B',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder1/file2.txt:100B',
+        ]
+
+        expected = [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+        ]
+
+        dirs = [
+            'folder1'
+        ]
+
+        self.execute(input, expected, dirs, complete_hash=True)
+
     def test_separate_dirs(self):
         input = [
             'folder1/file1a.txt',
@@ -412,6 +537,292 @@ class TestDupeAnalysis(unittest.TestCase):
 
         self.execute(input, expected, dirs, input2, dirs2)
 
+    def test_device_groups(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder2/file1b.txt==folder1/file1a.txt',
+            'folder3/file1c.txt==folder1/file1a.txt',
+            'folder3/file2.txt',
+        ]
+        self.generate_file_structure(input)
+        dirs = [os.path.join(self.test_root, d)
+                for d in ('folder1', 'folder2', 'folder3')]
+
+        # folder1 on one device, folder2 and folder3 sharing another
+        def device(path):
+            return 1 if path.endswith('folder1') else 2
+
+        analyze_paths = DupeAnalysis._analyze_paths
+        with mock.patch.object(DupeAnalysis, '_device', side_effect=device), \
+             mock.patch.object(DupeAnalysis, '_analyze_paths', autospec=True,
+                               side_effect=analyze_paths) as mocked:
+            analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root,
+                                    workers=4)
+            analysis.load(dirs)
+            actual = analysis.get_duplicates()['dupes']
+            analysis.close()
+
+        groups = sorted(sorted(call.args[1]) for call in mocked.call_args_list)
+        self.assertEqual(groups, [[dirs[0]], [dirs[1], dirs[2]]])
+        # the hash workers are split between the devices, and each
+        #  device draws its progress bars on its own line
+        self.assertEqual({call.kwargs['workers']
+                          for call in mocked.call_args_list}, {2})
+        self.assertEqual(sorted(call.args[2] for call in mocked.call_args_list),
+                         [0, 1])
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1a.txt',
+                'folder2/file1b.txt',
+                'folder3/file1c.txt',
+                ],
+        ])
+
+    def test_refresh_only_loaded(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder2/file1b.txt==folder1/file1a.txt',
+        ]
+        self.generate_file_structure(input)
+        dirs = [os.path.join(self.test_root, d)
+                for d in ('folder1', 'folder2')]
+
+        # nothing was loaded, so nothing is walked a second time
+        with mock.patch.object(DupeAnalysis, '_refresh') as refresh:
+            analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root,
+                                    refresh=True)
+            analysis.load(dirs)
+            analysis.close()
+        refresh.assert_not_called()
+
+        # with folder1 loaded from its own database, only it is refreshed
+        os.remove(DupeAnalysis._get_db_path(set(dirs), self.db_root))
+        os.remove(DupeAnalysis._get_db_path({dirs[1]}, self.db_root))
+        with mock.patch.object(DupeAnalysis, '_refresh',
+                               autospec=True) as refresh:
+            analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root,
+                                    refresh=True)
+            analysis.load(dirs)
+            analysis.close()
+        self.assertEqual([call.args[0].paths
+                          for call in refresh.call_args_list],
+                         [{dirs[0]}])
+
+    def test_outdated_db(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder1/file1b.txt==folder1/file1a.txt',
+        ]
+        self.generate_file_structure(input)
+        dirs = {os.path.join(self.test_root, 'folder1')}
+
+        # a database left by an older version, without the inode column
+        db_path = DupeAnalysis._get_db_path(dirs, self.db_root)
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TABLE files (id INTEGER PRIMARY KEY, path TEXT)")
+        conn.execute("PRAGMA user_version = 1")
+        conn.commit()
+        conn.close()
+
+        # passed by hand it is refused rather than half used
+        analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root,
+                                refresh=True)
+        with self.assertRaises(RuntimeError):
+            analysis.load(dirs, manual_db=db_path)
+
+        # found in db_root it is moved aside and the dirs are analyzed again
+        analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root)
+        analysis.load(dirs)
+        actual = analysis.get_duplicates()['dupes']
+        analysis.close()
+
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+        ])
+        self.assertEqual(DupeAnalysis._get_db_version(db_path),
+                         DupeAnalysis.db_version)
+        self.assertEqual(DupeAnalysis._get_db_version(f"{db_path}.v1.bak"), 1)
+        conn = sqlite3.connect(db_path)
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+        conn.close()
+        self.assertEqual(journal_mode, 'delete')
+
+    def test_refresh(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder1/file2.txt',
+            'folder1/file3.txt',
+        ]
+
+        dirs = [
+            os.path.join(self.test_root, 'folder1'),
+        ]
+
+        self.generate_file_structure(input)
+        actual = self.execute_default(dirs, complete_hash=False,
+                                      excludes=[], hash_name='sha1')
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+        ])
+
+        # rewrite file1b with the same size, and add a copy of file2
+        changes = [
+            'folder1/file1b.txt==folder1/file3.txt',
+            'folder1/file2b.txt==folder1/file2.txt',
+        ]
+        self.generate_file_structure(changes)
+        path = os.path.join(self.test_root, 'folder1/file1b.txt')
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+        analysis = DupeAnalysis(debug=self.debug,
+                                db_root=self.db_root,
+                                refresh=True)
+        analysis.load(dirs)
+        actual = analysis.get_duplicates()['dupes']
+        analysis.close()
+
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1b.txt',
+                'folder1/file3.txt',
+                ],
+            [
+                'folder1/file2.txt',
+                'folder1/file2b.txt',
+                ],
+        ])
+
+    def test_refresh_replaced(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder1/file2.txt',
+        ]
+
+        dirs = [
+            os.path.join(self.test_root, 'folder1'),
+        ]
+
+        self.generate_file_structure(input)
+        actual = self.execute_default(dirs, complete_hash=False,
+                                      excludes=[], hash_name='sha1')
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+        ])
+
+        # swap in a copy of file1a for file2 with file2's size and mtime,
+        #  the way cp -p or rsync would
+        self.generate_file_structure([
+            'folder1/file2.tmp==folder1/file1a.txt',
+        ])
+        path = os.path.join(self.test_root, 'folder1/file2.txt')
+        tmp = os.path.join(self.test_root, 'folder1/file2.tmp')
+        stat = os.stat(path)
+        os.utime(tmp, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(tmp, path)
+
+        analysis = DupeAnalysis(debug=self.debug,
+                                db_root=self.db_root,
+                                refresh=True)
+        analysis.load(dirs)
+        actual = analysis.get_duplicates()['dupes']
+        analysis.close()
+
+        self.validate_duplicates(actual, [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                'folder1/file2.txt',
+                ],
+        ])
+
+    def test_only_subdir(self):
+        input = [
+            'folder1/file1.txt',
+            'folder1/only/inner/file2a.txt',
+            'folder1/only/inner/file2b.txt==folder1/only/inner/file2a.txt',
+            'folder1/two/x/file3.txt',
+            'folder1/two/y/file4.txt',
+        ]
+        self.generate_file_structure(input)
+        root = os.path.join(self.test_root, 'folder1')
+
+        analysis = DupeAnalysis(debug=self.debug, db_root=self.db_root)
+        analysis.load([root])
+        only = analysis.get_only_subdir(os.path.join(root, 'only'))
+        has_files = analysis.get_only_subdir(root)
+        two = analysis.get_only_subdir(os.path.join(root, 'two'))
+        leaf = analysis.get_only_subdir(os.path.join(root, 'only/inner'))
+        analysis.close()
+
+        self.assertEqual(only, os.path.join(root, 'only/inner'))
+        self.assertIsNone(has_files)
+        self.assertIsNone(two)
+        self.assertIsNone(leaf)
+
+    def test_unbatched_quoted_dir(self):
+        input = [
+            "folder1/it's/sub/file1a.txt",
+            "folder1/it's/sub/file1b.txt==folder1/it's/sub/file1a.txt",
+        ]
+        self.generate_file_structure(input)
+        root = os.path.join(self.test_root, 'folder1')
+
+        # batch_limit=1 inserts each directory's subdirs as it is walked
+        analysis = DupeAnalysis(db_root=self.db_root, batch_limit=1)
+        analysis.load([root])
+        only = analysis.get_only_subdir(os.path.join(root, "it's"))
+        analysis.close()
+
+        self.assertEqual(only, os.path.join(root, "it's/sub"))
+
+    def test_walk_listing_error(self):
+        input = [
+            'folder1/good/file1.txt',
+            'folder1/bad/file2.txt',
+        ]
+        self.generate_file_structure(input)
+        root = os.path.join(self.test_root, 'folder1')
+
+        scandir = os.scandir
+
+        class FailingListing:
+            # lists one entry, then fails like a stale NFS handle
+            def __init__(self, path):
+                self.it = scandir(path)
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                self.it.close()
+            def __iter__(self):
+                return self
+            def __next__(self):
+                next(self.it)
+                raise OSError(errno.ESTALE, 'Stale file handle')
+
+        def flaky_scandir(path):
+            if path.endswith('bad'):
+                return FailingListing(path)
+            return scandir(path)
+
+        with mock.patch('os.scandir', flaky_scandir):
+            roots = [dirpath for dirpath, dirs, files
+                     in DupeAnalysis.walk(root)]
+
+        self.assertEqual(sorted(roots),
+                         [root, os.path.join(root, 'good')])
+
     def test_db_merge2(self):
         input = [
             'folder1/file1a.txt',
@@ -468,11 +879,13 @@ class TestDupeAnalysis(unittest.TestCase):
 
     def test_complete_hash(self):
         input = [
-            'folder1/file1a.txt:5KB',
-            'folder1/file1b.txt==folder1/file1a.txt',
-            'folder1/pad1.txt:1KB',
+            'folder1/file1a.txt:100KB',
+            'folder1/file1b.txt==folder1/file1a.txt:100KB',
+            'folder1/pad1.txt:49664B',
             'folder1/pad2.txt:2KB',
-            'folder1/file1c.txt==folder1/file1a.txt:1KB+folder1/pad1.txt+folder1/file1a.txt:2KB-3KB+folder1/pad1.txt+folder1/file1a.txt:4KB-5KB',
+            # same beginning, middle and end chunks as file1a, but files
+            #  this big are only sampled unless complete_hash is set
+            'folder1/file1c.txt==folder1/file1a.txt:1KB+folder1/pad1.txt:49664B+folder1/file1a.txt:50688B-51712B+folder1/pad1.txt:49664B+folder1/file1a.txt:99KB-100KB',
             'folder1/file1d.txt==folder1/file1a.txt:1KB+folder1/pad2.txt',
             'folder1/file2.txt:32B',
             'folder1/file3.txt:64B',
@@ -497,11 +910,13 @@ class TestDupeAnalysis(unittest.TestCase):
 
     def test_complete_hash_false(self):
         input = [
-            'folder1/file1a.txt:5KB',
-            'folder1/file1b.txt==folder1/file1a.txt',
-            'folder1/pad1.txt:1KB',
+            'folder1/file1a.txt:100KB',
+            'folder1/file1b.txt==folder1/file1a.txt:100KB',
+            'folder1/pad1.txt:49664B',
             'folder1/pad2.txt:2KB',
-            'folder1/file1c.txt==folder1/file1a.txt:1KB+folder1/pad1.txt+folder1/file1a.txt:2KB-3KB+folder1/pad1.txt+folder1/file1a.txt:4KB-5KB',
+            # same beginning, middle and end chunks as file1a, but files
+            #  this big are only sampled unless complete_hash is set
+            'folder1/file1c.txt==folder1/file1a.txt:1KB+folder1/pad1.txt:49664B+folder1/file1a.txt:50688B-51712B+folder1/pad1.txt:49664B+folder1/file1a.txt:99KB-100KB',
             'folder1/file1d.txt==folder1/file1a.txt:1KB+folder1/pad2.txt',
             'folder1/file2.txt:32B',
             'folder1/file3.txt:64B',
@@ -525,6 +940,38 @@ class TestDupeAnalysis(unittest.TestCase):
 
         self.execute(input, expected, dirs)
 
+    def test_hash_name(self):
+        input = [
+            'folder1/file1a.txt',
+            'folder1/file1b.txt==folder1/file1a.txt',
+            'folder1/file2.txt',
+            'folder1/file3.txt:100B',
+            'folder1/file3b.txt==folder1/file3.txt',
+        ]
+
+        expected = [
+            [
+                'folder1/file1a.txt',
+                'folder1/file1b.txt',
+                ],
+            [
+                'folder1/file3.txt',
+                'folder1/file3b.txt',
+                ],
+        ]
+
+        dirs = [
+            'folder1'
+        ]
+
+        self.execute(input, expected, dirs, complete_hash=True,
+                     hash_name='blake2b')
+
+    def test_hash_name_variable_length(self):
+        for hash_name in ('shake_128', 'shake_256'):
+            with self.assertRaises(RuntimeError):
+                DupeAnalysis(db_root=self.db_root, hash_name=hash_name)
+
     def test_exclude(self):
         input = [
             'folder1/file1a.txt',